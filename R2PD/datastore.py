@@ -344,7 +344,10 @@ class InternalDataStore(DataStore):
         cache_meta : 'pandas.DataFrame'
             Updated DataFrame of resource files in cache
         """
-        cache_sites = cache_meta.index
+        # Collect cached resources by site and build cache_meta once rather
+        # than enlarging it a row at a time
+        cache = cache_meta.to_dict('index')
+        columns = list(cache_meta.columns)
 
         for file in os.listdir(cache_path):
             if file.endswith('.hdf5'):
@@ -352,12 +355,14 @@ class InternalDataStore(DataStore):
                 _, resource, site_id = name.split('_')
                 site_id = int(site_id)
 
-                if site_id not in cache_sites:
-                    cache_meta.loc[site_id] = False
+                if resource not in columns:
+                    columns.append(resource)
 
-                cache_meta.loc[site_id, resource] = True
+                cache.setdefault(site_id, {})[resource] = True
 
-        cache_sites = cache_meta.index
+        cache_meta = pds.DataFrame.from_dict(cache, orient='index')
+        cache_meta = cache_meta.reindex(columns=columns).eq(True)
+        cache_meta.index.name = 'site_id'
 
         return cache_meta
 
@@ -723,8 +728,19 @@ class ExternalDataStore(DataStore):
             else:
                 resource_type = 'power'
 
-            site_ids = np.concatenate(nearest_nodes['site_id'].values)
-            site_ids = np.unique(site_ids)
+            # Nodes w/ zero capacity, or that could not be filled because
+            # resource capacity was exhausted, have no resource sites
+            unmatched = nearest_nodes['site_id'].map(len) == 0
+            if unmatched.any():
+                msg = ('No resource sites could be assigned to nodes {}, '
+                       'check that they have a positive capacity and that '
+                       'enough resource capacity is available'
+                       .format(list(nearest_nodes.index[unmatched])))
+                raise RuntimeError(msg)
+
+            site_ids = [site_id for sites in nearest_nodes['site_id']
+                        for site_id in sites]
+            site_ids = np.unique(np.array(site_ids, dtype=int))
         else:
             resource_type = 'met'
             site_ids = nearest_nodes['site_id'].values
@@ -2,11 +2,152 @@
 This module provides classes for facilitating the transfer of data between
 the external and internal store as well as processing the data using a queue.
 """
+import logging
 import numpy as np
 import pandas as pds
 from scipy.spatial import cKDTree
 from R2PD.powerdata import NodeCollection
 
+logger = logging.getLogger(__name__)
+
+
+def _ll_to_xyz(lat, lon):
+    """
+    Convert latitude and longitude in degrees to cartesian coordinates on
+    the unit sphere. Euclidean distance between the converted points
+    increases monotonically with great-circle distance, so nearest neighbors
+    found by cKDTree are also nearest on the globe.
+
+    Parameters
+    ----------
+    lat : 'ndarray'
+        Latitudes in degrees
+    lon : 'ndarray'
+        Longitudes in degrees
+
+    Returns
+    ---------
+    xyz : 'ndarray'
+        C-contiguous float64 n x 3 array of [x, y, z] on the unit sphere
+    """
+    lat = np.deg2rad(np.asarray(lat, dtype=np.float64))
+    lon = np.deg2rad(np.asarray(lon, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    xyz = np.stack([cos_lat * np.cos(lon), cos_lat * np.sin(lon),
+                    np.sin(lat)], axis=1)
+    return np.ascontiguousarray(xyz)
+
+
+def _query_nearest(tree, xyz, k):
+    """
+    Find the k nearest neighbors in tree of each point in xyz. The search is
+    first bounded by a radius estimated from a sample of xyz, which prunes
+    most of the tree traversal, points w/o k neighbors inside the radius
+    are then re-queried w/o a bound. If the radius is 0 the search is not
+    bounded.
+
+    Parameters
+    ----------
+    tree : 'cKDTree'
+        Tree to query
+    xyz : 'ndarray'
+        n x 3 array of points to query
+    k : 'int'
+        Number of nearest neighbors to find
+
+    Returns
+    ---------
+    dist : 'ndarray'
+        n x k array of distances to the nearest neighbors
+    pos : 'ndarray'
+        n x k array of positions of the nearest neighbors in tree
+    """
+    if tree.n == 0:
+        raise ValueError('Cannot find nearest resource nodes, resource meta '
+                         'data does not contain any sites')
+
+    n = len(xyz)
+    if n == 0:
+        return np.zeros((0, k)), np.zeros((0, k), dtype=int)
+
+    sample = xyz[::max(1, n // 100)]
+    sample_dist, _ = tree.query(sample, k=k, workers=-1)
+    sample_dist = sample_dist.reshape(len(sample), k)[:, -1]
+    radius = 1.5 * np.percentile(sample_dist, 95)
+    if radius == 0:
+        # Points sit on resource nodes, distance_upper_bound is strict so a
+        # bounded search would miss every point
+        dist, pos = tree.query(xyz, k=k, workers=-1)
+        return dist.reshape(n, k), pos.reshape(n, k)
+
+    dist, pos = tree.query(xyz, k=k, workers=-1, distance_upper_bound=radius)
+    dist = dist.reshape(n, k)
+    pos = pos.reshape(n, k)
+    missed = np.isinf(dist[:, -1])
+    if missed.any():
+        m_dist, m_pos = tree.query(xyz[missed], k=k, workers=-1)
+        dist[missed] = m_dist.reshape(-1, k)
+        pos[missed] = m_pos.reshape(-1, k)
+
+    return dist, pos
+
+
+def _greedy_fill(n_pos, k_dist, k_pos, first, r_cap, r_capacity, n_rcap):
+    """
+    Pair each resource node w/ remaining capacity with the nearest requested
+    node it is the first available candidate for, and apply its capacity to
+    that node. r_cap and n_rcap are updated in place.
+
+    Parameters
+    ----------
+    n_pos : 'ndarray'
+        Positions of requested nodes to be filled
+    k_dist : 'ndarray'
+        Distance to the candidate resource nodes of every requested node
+    k_pos : 'ndarray'
+        Positions of the candidate resource nodes of every requested node
+    first : 'ndarray'
+        Rank of the first candidate w/ remaining capacity of each node in
+        n_pos
+    r_cap : 'ndarray'
+        Remaining capacity of resource nodes
+    r_capacity : 'ndarray'
+        Capacity of resource nodes
+    n_rcap : 'ndarray'
+        Remaining capacity of requested nodes
+
+    Returns
+    ---------
+    pair_node : 'ndarray'
+        Positions of requested nodes that were matched
+    pair_res : 'ndarray'
+        Positions of resource nodes applied to pair_node
+    fracs : 'ndarray'
+        Fraction of each resource node applied to pair_node
+    """
+    dist = k_dist[n_pos, first]
+    pos = k_pos[n_pos, first]
+
+    # Find the nearest pair of resource nodes and requested nodes:
+    # sort by resource then distance, the first entry of each resource
+    # group is its nearest requested node
+    order = np.lexsort((dist, pos))
+    sorted_pos = pos[order]
+    starts = np.flatnonzero(np.r_[True, sorted_pos[1:] != sorted_pos[:-1]])
+    pair_res = sorted_pos[starts]
+    pair_node = n_pos[order[starts]]
+
+    # Apply resource node to nearest requested node, each resource and
+    # requested node appears in at most one pair so the updates
+    # can be applied at once
+    take = np.minimum(n_rcap[pair_node], r_cap[pair_res])
+    # Fraction of resource node to apply to requested node
+    fracs = take / r_capacity[pair_res]
+    r_cap[pair_res] -= take
+    n_rcap[pair_node] -= take
+
+    return pair_node, pair_res, fracs
+
 
 def nearest_power_nodes(node_collection, resource_meta):
     """
@@ -26,89 +167,129 @@ def nearest_power_nodes(node_collection, resource_meta):
     Returns
     ---------
     nodes : 'pandas.DataFrame'
-        Requested nodes with site_ids and fractions of resource for each node
+        Requested nodes with site_ids and fractions of resource for each node.
+        If resource capacity is exhausted before all nodes are filled, the
+        unfilled nodes keep the sites matched so far; nodes w/ zero capacity
+        or w/o any match have empty site_id and site_fracs lists
     """
     if isinstance(node_collection, NodeCollection):
         node_data = node_collection.node_data
     else:
         node_data = node_collection
 
-    # Create and populate DataFrame from requested list of nodes
-    nodes = pds.DataFrame(columns=['latitude', 'longitude', 'capacity',
-                                   'site_id', 'site_fracs', 'r_cap'],
-                          index=node_data.index)
+    # Requested nodes lat, lon and capacity
+    n_lat = node_data['latitude'].to_numpy()
+    n_lon = node_data['longitude'].to_numpy()
+    n_capacity = node_data['capacity (MW)'].to_numpy(dtype=float)
+    n_nodes = len(node_data)
+
+    # Matching state is held in arrays indexed by position
+    r_lat = resource_meta['latitude'].to_numpy()
+    r_lon = resource_meta['longitude'].to_numpy()
+    r_capacity = resource_meta['capacity'].to_numpy(dtype=float)
+    # Remaining capacity available at resource node
+    r_cap = r_capacity.copy()
+    r_index = resource_meta.index.to_numpy()
+    # Remaining capacity to be filled at requested node
+    n_rcap = n_capacity.copy()
+    # Matched (requested node, resource node, fraction) from each iteration
+    match_node = [np.zeros(0, dtype=int)]
+    match_res = [np.zeros(0, dtype=int)]
+    match_frac = [np.zeros(0)]
+
+    # Create cKDTree of [lat, lon] for all resource nodes once, resource
+    # nodes w/o remaining capacity are skipped when matching.
+    # The tree is only queried a few times, so build it w/ the faster
+    # sliding midpoint rule instead of median splits
+    r_xyz = _ll_to_xyz(r_lat, r_lon)
+    tree = cKDTree(r_xyz, balanced_tree=False)
+    n_res = len(r_cap)
+
+    node_xyz = _ll_to_xyz(n_lat, n_lon)
 
-    nodes.loc[:, ['latitude', 'longitude', 'capacity']] = node_data.values
-    nodes.loc[:, 'r_cap'] = node_data['capacity (MW)']
-
-    r_nodes = resource_meta[['longitude', 'latitude', 'capacity']].copy()
-    # Add placeholder for remaining capacity available at resource node
-    r_nodes['r_cap'] = r_nodes['capacity']
-
-    while True:
-        # Extract resource nodes w/ remaining capacity
-        r_left = r_nodes[r_nodes['r_cap'] > 0]
-        r_index = r_left.index
-        try:
-            lat_lon = r_left[['latitude', 'longitude']].to_numpy()
-        except:
-            # To support pandas versions < 0.24.0
-            lat_lon = r_left[['latitude', 'longitude']].values
-        # Create cKDTree of [lat, lon] for resource nodes
-        # w/ available capacity
-        tree = cKDTree(lat_lon)
-
-        # Extract nodes that still have capacity to be filled
-        nodes_left = nodes[nodes['r_cap'] > 0]
-        n_index = nodes_left.index
-        try:
-            node_lat_lon = nodes_left[['latitude', 'longitude']].to_numpy()
-        except:
-            # To support pandas versions < 0.24.0
-            node_lat_lon = nodes_left[['latitude', 'longitude']].values
-
-        # Find first nearest resource node to each requested node
-        dist, pos = tree.query(node_lat_lon, k=1)
-        node_pairs = pds.DataFrame({'pos': pos, 'dist': dist})
-        # Find the nearest pair of resource nodes and requested nodes
-        node_pairs = node_pairs.groupby('pos')['dist'].idxmin()
-
-        # Apply resource node to nearest requested node
-        for i, n in node_pairs.iteritems():
-            r_i = r_index[i]
-            n_i = n_index[n]
-            resource = r_nodes.loc[r_i].copy()
-            file_id = resource.name
-            cap = resource['r_cap']
-            node = nodes.loc[n_i].copy()
-
-            # Determine fract of resource node to apply to requested node
-            if node['r_cap'] > cap:
-                frac = cap / resource['capacity']
-                resource['r_cap'] = 0
-                node['r_cap'] += -1 * cap
-            else:
-                frac = node['r_cap'] / resource['capacity']
-                resource['r_cap'] += -1 * node['r_cap']
-                node['r_cap'] = 0
-
-            if np.all(pds.isnull(node['site_id'])):
-                node['site_id'] = [file_id]
-                node['site_fracs'] = [frac]
-            else:
-                node['site_id'] += [file_id]
-                node['site_fracs'] += [frac]
-
-            r_nodes.loc[r_i] = resource
-            nodes.loc[n_i] = node
-
-        # Continue nearest neighbor search and resource distribution
-        # until capacity is filled for all requested nodes
-        if np.sum(nodes['r_cap'] > 0) == 0:
+    # Query the k nearest resource nodes to each requested node once,
+    # k_first is the rank of the first candidate of each node that may
+    # still have remaining capacity
+    k = min(8, n_res)
+    k_dist, k_pos = _query_nearest(tree, node_xyz, k)
+    k_first = np.zeros(n_nodes, dtype=int)
+    # Number of resource nodes w/ remaining capacity
+    r_left = np.count_nonzero(r_cap > 0)
+    # Exhausted candidates are replaced from r_tree, it covers every
+    # resource node w/ remaining capacity, r_tree_pos maps its points
+    # to resource node positions
+    r_tree = tree
+    r_tree_pos = np.arange(n_res)
+
+    # Positions of nodes that still have capacity to be filled, continue
+    # nearest neighbor search and resource distribution until capacity
+    # is filled for all requested nodes
+    n_pos = np.flatnonzero(n_rcap > 0)
+    while len(n_pos) > 0:
+        # Stop if no resource node w/ remaining capacity is left, before
+        # searching for candidates that cannot exist
+        if r_left == 0:
+            logger.warning('Resource capacity is exhausted, {} requested '
+                           'nodes could not be filled'.format(len(n_pos)))
             break
 
-    return nodes[['latitude', 'longitude', 'capacity', 'site_id',
-                  'site_fracs']]
+        # Advance nodes whose first candidate is exhausted to their next
+        # candidate w/ remaining capacity. Nodes whose candidates are all
+        # exhausted get the k nearest resource nodes in r_tree, if those
+        # are all exhausted too r_tree is rebuilt from the resource nodes
+        # w/ remaining capacity, whose nearest point is then available
+        stale = n_pos[r_cap[k_pos[n_pos, k_first[n_pos]]] <= 0]
+        for attempt in range(3):
+            available = ((np.arange(k) >= k_first[stale][:, None])
+                         & (r_cap[k_pos[stale]] > 0))
+            found = available.any(axis=1)
+            k_first[stale[found]] = available[found].argmax(axis=1)
+            stale = stale[~found]
+            if len(stale) == 0:
+                break
+
+            if attempt == 1:
+                r_tree_pos = np.flatnonzero(r_cap > 0)
+                r_tree = cKDTree(r_xyz[r_tree_pos], balanced_tree=False)
+
+            n_k = min(k, len(r_tree_pos))
+            e_dist, e_pos = r_tree.query(node_xyz[stale], k=n_k, workers=-1)
+            # Repeat the last candidate if r_tree has less than k points
+            cols = np.minimum(np.arange(k), n_k - 1)
+            k_dist[stale] = e_dist.reshape(len(stale), n_k)[:, cols]
+            k_pos[stale] = r_tree_pos[e_pos.reshape(len(stale), n_k)[:, cols]]
+            # Search the new candidates from the start
+            k_first[stale] = 0
+
+        pair_node, pair_res, fracs = _greedy_fill(n_pos, k_dist, k_pos,
+                                                  k_first[n_pos], r_cap,
+                                                  r_capacity, n_rcap)
+        r_left -= np.count_nonzero(r_cap[pair_res] <= 0)
+        match_node.append(pair_node)
+        match_res.append(pair_res)
+        match_frac.append(fracs)
+
+        # Drop nodes that were filled in this iteration
+        n_pos = n_pos[n_rcap[n_pos] > 0]
+
+    # Group matches by requested node in CSR layout, site_id and site_fracs
+    # of node i are stored in [indptr[i]:indptr[i + 1]]
+    match_node = np.concatenate(match_node)
+    order = np.argsort(match_node, kind='stable')
+    site_ids = r_index[np.concatenate(match_res)[order]]
+    site_fracs = np.concatenate(match_frac)[order]
+    indptr = np.searchsorted(match_node[order], np.arange(n_nodes + 1))
+
+    windows = list(zip(indptr[:-1], indptr[1:]))
+    nodes = pds.DataFrame({'latitude': n_lat, 'longitude': n_lon,
+                           'capacity': n_capacity,
+                           'site_id': [site_ids[i:j].tolist()
+                                       for i, j in windows],
+                           'site_fracs': [site_fracs[i:j].tolist()
+                                          for i, j in windows]},
+                          index=node_data.index)
+
+    return nodes
 
 
 def nearest_met_nodes(node_collection, resource_meta):
@@ -136,21 +317,19 @@ def nearest_met_nodes(node_collection, resource_meta):
     else:
         node_data = node_collection
 
-    # Create and populate DataFrame from requested list of nodes
-    nodes = pds.DataFrame(columns=['latitude', 'longitude', 'site_id'],
-                          index=node_data.index)
-
-    nodes.loc[:, ['latitude', 'longitude']] = node_data.values
+    # Create cKDTree of [lat, lon] for resource nodes, it is queried once
+    # so build it w/ the faster sliding midpoint rule
+    tree = cKDTree(_ll_to_xyz(resource_meta['latitude'].to_numpy(),
+                              resource_meta['longitude'].to_numpy()),
+                   balanced_tree=False)
 
-    # Extract resource nodes lat, lon
-    lat_lon = resource_meta.as_matrix(['latitude', 'longitude'])
-    # Create cKDTree of [lat, lon] for resource nodes w/ available capacity
-    tree = cKDTree(lat_lon)
-
-    # Extract requested lat, lon
-    node_lat_lon = nodes.as_matrix(['latitude', 'longitude'])
     # Find first nearest resource node to each requested node
-    _, site_id = tree.query(node_lat_lon, k=1)
-    nodes['site_id'] = site_id
+    lat = node_data['latitude'].to_numpy()
+    lon = node_data['longitude'].to_numpy()
+    _, site_id = _query_nearest(tree, _ll_to_xyz(lat, lon), 1)
+
+    nodes = pds.DataFrame({'latitude': lat, 'longitude': lon,
+                           'site_id': site_id[:, 0]},
+                          index=node_data.index)
 
-    return nodes[['latitude', 'longitude', 'site_id']]
+    return nodes
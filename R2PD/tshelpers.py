@@ -4,6 +4,7 @@ as well as abstract function calls for converting between them.
 """
 import abc
 from enum import Enum
+import functools
 import numpy as np
 import pandas as pds
 
@@ -41,7 +42,10 @@ class TemporalParameters(object):
         self.point_interp = get_enum_instance(point_interp,
                                               self.POINT_INTERPRETATIONS)
         self.timezone = timezone
-        self.resolution = pds.to_timedelta(resolution)
+        if resolution is not None:
+            resolution = pds.to_timedelta(resolution)
+
+        self.resolution = resolution
 
     @classmethod
     def infer_params(cls, ts, timezone=None, **kwargs):
@@ -81,8 +85,17 @@ class TemporalParameters(object):
         ts : 'pandas.DataFrame'
             Timeseries DataFrame
         """
-        time_index = ts.index
-        resolution = pds.to_timedelta(time_index[1] - time_index[0])
+        # Work on the underlying datetime64 values, avoids DatetimeIndex
+        # arithmetic
+        time_index = ts.index.values
+        time_step = time_index[1] - time_index[0]
+        msg = 'Time-series does not have a constant temporal resolution'
+        # A missing or extra time-step is caught from the extent alone,
+        # otherwise check every step in a single pass
+        extent = time_index[-1] - time_index[0]
+        assert extent == time_step * (len(time_index) - 1), msg
+        assert np.all(np.diff(time_index) == time_step), msg
+        resolution = pds.to_timedelta(time_step)
         self.resolution = resolution
 
     def infer_timezone(self, ts):
@@ -419,4 +432,25 @@ def get_enum_instance(value, enum_class):
     'enum_class'
         enum_class value
     """
-    return value if isinstance(value, enum_class) else enum_class[value]
+    return (value if isinstance(value, enum_class)
+            else _enum_lookup(enum_class, value))
+
+
+@functools.lru_cache(maxsize=None)
+def _enum_lookup(enum_class, name):
+    """
+    Cached lookup of enum_class member by name
+
+    Parameters
+    ----------
+    enum_class : 'Enum'
+        enum class object for which name belongs
+    name : 'str'
+        Name of enum_class value
+
+    Returns
+    -------
+    'enum_class'
+        enum_class value
+    """
+    return enum_class[name]
@@ -79,12 +79,12 @@ setup(
         "Intended Audience :: Developers",
         "License :: OSI Approved :: MIT License",
         "Natural Language :: English",
-        "Programming Language :: Python :: 2.7",
-        "Programming Language :: Python :: 3.5",
-        "Programming Language :: Python :: 3.6",
+        "Programming Language :: Python :: 3.7",
     ],
+    python_requires=">=3.7",
     test_suite="tests",
-    install_requires=["click", "future", "pandas", "numpy", "h5py", "scipy"],
+    install_requires=["click", "future", "pandas>=0.24", "numpy>=1.16.5",
+                      "h5py", "scipy>=1.6"],
     extras_require={
         "test": test_requires,
         "dev": test_requires + ["pypandoc", "pre-commit"],
@@ -0,0 +1,208 @@
+import time
+import tracemalloc
+import numpy as np
+import pandas as pds
+import pytest
+from scipy.spatial import cKDTree
+from R2PD.nearestnodes import (nearest_power_nodes, nearest_met_nodes,
+                               _ll_to_xyz)
+
+
+def greedy_power_nodes(node_data, resource_meta):
+    """
+    Reference implementation of the original greedy matching: every
+    iteration each unfilled node finds its nearest resource node w/
+    remaining capacity and each resource node is applied to the nearest
+    node that picked it.
+    """
+    r_xyz = _ll_to_xyz(resource_meta['latitude'], resource_meta['longitude'])
+    n_xyz = _ll_to_xyz(node_data['latitude'], node_data['longitude'])
+    r_capacity = resource_meta['capacity'].to_numpy(dtype=float)
+    r_cap = r_capacity.copy()
+    n_rcap = node_data['capacity (MW)'].to_numpy(dtype=float).copy()
+    site_ids = [[] for _ in range(len(node_data))]
+    site_fracs = [[] for _ in range(len(node_data))]
+
+    while (n_rcap > 0).any() and (r_cap > 0).any():
+        r_pos = np.flatnonzero(r_cap > 0)
+        n_pos = np.flatnonzero(n_rcap > 0)
+        dist, pos = cKDTree(r_xyz[r_pos]).query(n_xyz[n_pos], k=1)
+        nearest = {}
+        for n, (d, p) in enumerate(zip(dist, pos)):
+            if p not in nearest or d < nearest[p][0]:
+                nearest[p] = (d, n)
+
+        for p, (_, n) in nearest.items():
+            r_i = r_pos[p]
+            n_i = n_pos[n]
+            take = min(n_rcap[n_i], r_cap[r_i])
+            r_cap[r_i] -= take
+            n_rcap[n_i] -= take
+            site_ids[n_i].append(resource_meta.index[r_i])
+            site_fracs[n_i].append(take / r_capacity[r_i])
+
+    return site_ids, site_fracs
+
+
+def random_inputs(seed, n_nodes, n_res, excess=1.5):
+    rng = np.random.RandomState(seed)
+    node_data = pds.DataFrame({'latitude': rng.uniform(30, 45, n_nodes),
+                               'longitude': rng.uniform(-120, -80, n_nodes),
+                               'capacity (MW)': rng.uniform(1, 50, n_nodes)})
+    node_data.index.name = 'node_id'
+    capacity = rng.uniform(1, 20, n_res)
+    capacity *= excess * node_data['capacity (MW)'].sum() / capacity.sum()
+    resource_meta = pds.DataFrame({'latitude': rng.uniform(30, 45, n_res),
+                                   'longitude': rng.uniform(-120, -80, n_res),
+                                   'capacity': capacity},
+                                  index=rng.permutation(n_res) * 3)
+    resource_meta.index.name = 'site_id'
+    return node_data, resource_meta
+
+
+def grid_meta(n=12, step=0.25):
+    lat, lon = np.meshgrid(np.arange(n) * step, np.arange(n) * step,
+                           indexing='ij')
+    resource_meta = pds.DataFrame({'latitude': lat.ravel(),
+                                   'longitude': lon.ravel(),
+                                   'capacity': 1.0})
+    resource_meta.index.name = 'site_id'
+    return resource_meta
+
+
+def check_matches_greedy(node_data, resource_meta):
+    nodes = nearest_power_nodes(node_data, resource_meta)
+    site_ids, site_fracs = greedy_power_nodes(node_data, resource_meta)
+    assert nodes['site_id'].tolist() == site_ids
+    for fracs, truth in zip(nodes['site_fracs'], site_fracs):
+        assert np.allclose(fracs, truth)
+
+
+def check_nearest_invariant(node_data, resource_meta):
+    """
+    No node takes a resource node farther than one left w/ capacity
+    """
+    nodes = nearest_power_nodes(node_data, resource_meta)
+    used = pds.Series(0.0, index=resource_meta.index)
+    for sites, fracs in zip(nodes['site_id'], nodes['site_fracs']):
+        for site, frac in zip(sites, fracs):
+            used[site] += frac
+
+    left = (used < 1 - 1e-9).to_numpy()
+    if not left.any():
+        return
+
+    r_xyz = _ll_to_xyz(resource_meta['latitude'], resource_meta['longitude'])
+    n_xyz = _ll_to_xyz(node_data['latitude'], node_data['longitude'])
+    for xyz, sites in zip(n_xyz, nodes['site_id']):
+        dist = np.linalg.norm(r_xyz - xyz, axis=1)
+        taken = resource_meta.index.get_indexer(sites)
+        assert dist[taken].max() <= dist[left].min() + 1e-12
+
+
+def test_power_nodes_match_greedy_random():
+    for seed in range(5):
+        check_matches_greedy(*random_inputs(seed, 50, 400))
+
+
+def test_power_nodes_match_greedy_scarce():
+    for seed in range(5):
+        check_matches_greedy(*random_inputs(seed, 100, 120, excess=1.01))
+
+
+def test_power_nodes_match_greedy_grid():
+    resource_meta = grid_meta()
+    for seed in range(10):
+        rng = np.random.RandomState(seed)
+        node_data = pds.DataFrame({'latitude': rng.uniform(0, 2.75, 5),
+                                   'longitude': rng.uniform(0, 2.75, 5),
+                                   'capacity (MW)': rng.uniform(1, 25, 5)})
+        check_matches_greedy(node_data, resource_meta)
+
+
+def test_power_nodes_nearest_on_grid_ties():
+    resource_meta = grid_meta()
+    # Cell centers are equidistant to many sites
+    node_data = pds.DataFrame({'latitude': [0.125], 'longitude': [1.125],
+                               'capacity (MW)': [57.0]})
+    check_nearest_invariant(node_data, resource_meta)
+
+    for seed in range(50):
+        rng = np.random.RandomState(seed)
+        n = rng.randint(1, 6)
+        node_data = pds.DataFrame(
+            {'latitude': rng.randint(0, 11, n) * 0.25 + 0.125,
+             'longitude': rng.randint(0, 11, n) * 0.25 + 0.125,
+             'capacity (MW)': rng.randint(1, 30, n).astype(float)})
+        check_nearest_invariant(node_data, resource_meta)
+
+
+def test_power_nodes_capacity_exhausted(caplog):
+    node_data, resource_meta = random_inputs(0, 40, 30, excess=0.5)
+    nodes = nearest_power_nodes(node_data, resource_meta)
+    assert 'Resource capacity is exhausted' in caplog.text
+
+    # All resource capacity is used and no node is over filled
+    fracs = np.concatenate(nodes['site_fracs'].tolist())
+    assert np.isclose(fracs.sum(), len(resource_meta))
+    cap = resource_meta['capacity']
+    filled = [sum(cap[s] * f for s, f in zip(sites, fracs))
+              for sites, fracs in zip(nodes['site_id'], nodes['site_fracs'])]
+    assert np.all(np.array(filled) <= nodes['capacity'] + 1e-9)
+    site_ids, _ = greedy_power_nodes(node_data, resource_meta)
+    assert nodes['site_id'].tolist() == site_ids
+
+
+@pytest.mark.parametrize('excess', [1.01, 0.9])
+def test_power_nodes_scarce_bounded(excess):
+    """
+    Candidate search stays bounded when nodes exhaust the resource nodes
+    around them, previously k and the candidate arrays grew towards
+    n_nodes x n_res
+    """
+    node_data, resource_meta = random_inputs(0, 3000, 30000, excess=excess)
+    tracemalloc.start()
+    start = time.time()
+    nodes = nearest_power_nodes(node_data, resource_meta)
+    runtime = time.time() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    assert runtime < 20
+    assert peak < 100 * 2**20
+    site_ids, _ = greedy_power_nodes(node_data, resource_meta)
+    assert nodes['site_id'].tolist() == site_ids
+
+
+def test_power_nodes_empty():
+    node_data, resource_meta = random_inputs(0, 5, 20)
+    nodes = nearest_power_nodes(node_data.iloc[:0], resource_meta)
+    assert nodes.empty
+    assert list(nodes.columns) == ['latitude', 'longitude', 'capacity',
+                                   'site_id', 'site_fracs']
+
+    node_data.iloc[0, node_data.columns.get_loc('capacity (MW)')] = 0
+    nodes = nearest_power_nodes(node_data, resource_meta)
+    assert nodes['site_id'].iloc[0] == []
+    assert nodes['site_fracs'].iloc[0] == []
+
+    with pytest.raises(ValueError):
+        nearest_power_nodes(node_data, resource_meta.iloc[:0])
+
+
+def test_met_nodes():
+    node_data, resource_meta = random_inputs(1, 50, 400)
+    node_data = node_data[['latitude', 'longitude']]
+    nodes = nearest_met_nodes(node_data, resource_meta)
+    r_xyz = _ll_to_xyz(resource_meta['latitude'], resource_meta['longitude'])
+    n_xyz = _ll_to_xyz(node_data['latitude'], node_data['longitude'])
+    dist = np.linalg.norm(n_xyz[:, None] - r_xyz[None], axis=2)
+    assert np.array_equal(nodes['site_id'], dist.argmin(axis=1))
+
+    # Nodes on resource sites
+    nodes = nearest_met_nodes(resource_meta[['latitude', 'longitude']],
+                              resource_meta)
+    assert np.array_equal(nodes['site_id'], np.arange(len(resource_meta)))
+
+    with pytest.raises(ValueError):
+        nearest_met_nodes(node_data, resource_meta.iloc[:0])
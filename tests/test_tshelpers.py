@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pds
+import pytest
+from R2PD.tshelpers import TemporalParameters
+
+
+def hourly_ts(n=48):
+    time_index = pds.date_range('2012-01-01', periods=n, freq='h')
+    return pds.DataFrame({'power': np.arange(n, dtype=float)},
+                         index=time_index)
+
+
+def test_resolution_default():
+    tp = TemporalParameters(['2012-01-01', '2012-01-02'])
+    assert tp.resolution is None
+
+    tp = TemporalParameters(['2012-01-01', '2012-01-02'], resolution='5min')
+    assert tp.resolution == pds.Timedelta('5min')
+
+
+def test_infer_resolution():
+    ts = hourly_ts()
+    tp = TemporalParameters.infer_params(ts)
+    assert tp.resolution == pds.Timedelta('1h')
+    assert tp.point_interp == TemporalParameters.POINT_INTERPRETATIONS[
+        'instantaneous']
+
+    # An explicit resolution is not overwritten
+    tp = TemporalParameters.infer_params(ts, resolution='2h')
+    assert tp.resolution == pds.Timedelta('2h')
+
+
+def test_infer_resolution_gap():
+    # Missing time-step, caught by the extent check
+    ts = hourly_ts().drop(hourly_ts().index[5])
+    with pytest.raises(AssertionError):
+        TemporalParameters.infer_params(ts)
+
+
+def test_infer_resolution_uneven():
+    # Duplicated time-step followed by a double step spans the expected
+    # extent, caught by the step by step check
+    ts = hourly_ts()
+    time_index = ts.index.tolist()
+    time_index[5] = time_index[4]
+    ts.index = pds.DatetimeIndex(time_index)
+    with pytest.raises(AssertionError):
+        TemporalParameters.infer_params(ts)